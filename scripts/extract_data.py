@@ -1,111 +1,146 @@
-import xml.etree.ElementTree as ET
+from lxml import etree
 import boto3
-import io
-import csv
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import time
 import logging
-from io import BytesIO
+import tempfile
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
+from s3_cache import cached_download
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 s3 = boto3.client('s3')
 
-#Writes the csv files to buckets, take bucket name, key name, row names, and row generator with specific filter as input
-def stream_write(bucket, key, header, row_generator):
+#Part size of the multipart uploads, the parquet sinks also spill to disk past this size
+CHUNK_SIZE = 8 * 1024 * 1024
+#Number of records converted and written as one parquet row group
+BATCH_ROWS = 100_000
+#Fixed date format of the HealthKit export without its trailing ' -0600' offset, passing it skips pandas'
+#per-row format inference. Only the local wall-clock part is kept so daily buckets follow the wearer's day
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+transfer_config = TransferConfig(multipart_chunksize=CHUNK_SIZE, use_threads=True)
+
+#Naive timestamps holding the local wall-clock time of the export so downstream days are the wearer's days
+timestamp = pa.timestamp('ns')
+heart_schema = pa.schema([('created_at', timestamp), ('value', pa.float32())])
+sleep_schema = pa.schema([('created_at', timestamp), ('start_date', timestamp), ('end_date', timestamp)])
+count_schema = pa.schema([('created_at', timestamp), ('count', pa.float32())])
+
+#Opens a parquet sink for the schema, returns the buffer and its writer
+#the file is kept in memory up to CHUNK_SIZE and then spooled to a temporary file
+def open_sink(schema):
+    buffer = tempfile.SpooledTemporaryFile(max_size=CHUNK_SIZE, mode='w+b')
+    writer = pq.ParquetWriter(buffer, schema)
+    return buffer, writer
+
+#Converts the pending attribute strings to typed columns and writes them as one record batch
+#timestamps are parsed as local wall-clock time and numbers coerced to float32, unparseable values become nulls
+def write_batch(writer, rows):
+    arrays = []
+    for field, column in zip(writer.schema, zip(*rows)):
+        values = pd.Series(column)
+        if pa.types.is_timestamp(field.type):
+            values = pd.to_datetime(values.str[:19], format=DATE_FORMAT, errors='coerce')
+        else:
+            values = pd.to_numeric(values, errors='coerce').astype('float32')
+        arrays.append(pa.Array.from_pandas(values, type=field.type))
+    writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=writer.schema))
+
+#Uploads the parquet sink to buckets as a multipart upload, take bucket name, key name, buffer and row count as input
+def stream_write(bucket, key, buffer, count):
     logging.info(f"Writing to S3: {key}")
-    buffer = io.StringIO()
-    writer = csv.writer(buffer)
-    writer.writerow(header)
-
-    count = 0
-    for row in row_generator:
-        writer.writerow(row)
-        count += 1
-        if count % 50000 == 0:
-            logging.info(f"{key} - written {count} rows...")
-
-    s3.put_object(Bucket=bucket, Key=key, Body=buffer.getvalue())
+    buffer.seek(0)
+    s3.upload_fileobj(buffer, bucket, key, Config=transfer_config)
+    buffer.close()
     logging.info(f"Done writing {count} rows to {key}")
 
-#parse the xml file returned from the s3 has inner functions called generate row and row builder for each type - heart, steps,
-#respiratory etc...
+#parse the xml file returned from the s3 in a single pass, each record is dispatched by its type to the
+#row builder and parquet sink of heart, steps, respiratory etc...
 
 def parse_and_write(streaming_body):
-    logging.info("Starting XML parsing using ElementTree...")
-
-    #Generate row records based on the filter
-    def generate_rows(record_type_filter, row_builder):
-        context = ET.iterparse(streaming_body, events=('start',))
-        for event, element in context:
-            if element.tag != 'Record':
-                continue
-            if element.attrib.get('type') == record_type_filter:
-                try:
-                    yield row_builder(element)
-                except Exception as e:
-                    logging.warning(f"Skipped malformed record: {e}")
-            element.clear()
-
-    def heart_row(e):
-        return (
-            e.attrib.get('creationDate', ''),
-            e.attrib.get('value', '0')
-        )
-
-    def sleep_row(e):
-        return (
-            e.attrib.get('creationDate', ''),
-            e.attrib.get('startDate', ''),
-            e.attrib.get('endDate', '')
-        )
-
-    def step_row(e):
-        return (
-            e.attrib.get('creationDate', ''),
-            e.attrib.get('value', '0')
-        )
-
-    def resp_row(e):
-        return (
-            e.attrib.get('creationDate', ''),
-            e.attrib.get('value', '0')
-        )
-
-    stream_write('iwatch-healthdata-csv', 'processed/Heart_Data.csv',
-                 ('created_at', 'value'), generate_rows('HKQuantityTypeIdentifierHeartRate', heart_row))
-
-    streaming_body.seek(0) #Resets file pointer to the beginning so it can be parsed again
-
-    stream_write('iwatch-healthdata-csv', 'processed/Sleep_Data.csv',
-                 ('created_at', 'start_date', 'end_date'), generate_rows('HKCategoryTypeIdentifierSleepAnalysis', sleep_row))
-
-    streaming_body.seek(0)
-
-    stream_write('iwatch-healthdata-csv', 'processed/Step_Data.csv',
-                 ('created_at', 'count'), generate_rows('HKQuantityTypeIdentifierStepCount', step_row))
-
-    streaming_body.seek(0)
-
-    stream_write('iwatch-healthdata-csv', 'processed/Resp_Data.csv',
-                 ('created_at', 'count'), generate_rows('HKQuantityTypeIdentifierRespiratoryRate', resp_row))
-
-    logging.info("All CSVs written using ElementTree.")
+    logging.info("Starting XML parsing using lxml...")
+
+    #Record type -> (target key, schema, row builder)
+    #itemgetter pulls all attributes of a record in one C call instead of a Python builder per row
+    outputs = {
+        'HKQuantityTypeIdentifierHeartRate': ('processed/Heart_Data.parquet', heart_schema, itemgetter('creationDate', 'value')),
+        'HKCategoryTypeIdentifierSleepAnalysis': ('processed/Sleep_Data.parquet', sleep_schema, itemgetter('creationDate', 'startDate', 'endDate')),
+        'HKQuantityTypeIdentifierStepCount': ('processed/Step_Data.parquet', count_schema, itemgetter('creationDate', 'value')),
+        'HKQuantityTypeIdentifierRespiratoryRate': ('processed/Resp_Data.parquet', count_schema, itemgetter('creationDate', 'value')),
+    }
+
+    #Record type -> (target key, row builder), all the sinks are filled during the same pass
+    sinks = {}
+    pending = {}
+    counts = {}
+    dispatch = {}
+    for record_type, (key, schema, row_builder) in outputs.items():
+        sinks[key] = open_sink(schema)
+        pending[key] = []
+        counts[key] = 0
+        dispatch[record_type] = (key, row_builder)
+
+    #The tag filter runs inside lxml, Python only sees Record elements and never the Workout, Correlation or metadata ones
+    context = etree.iterparse(streaming_body, events=('end',), tag='{*}Record')
+    for event, element in context:
+        target = dispatch.get(element.get('type'))
+        if target is not None:
+            key, row_builder = target
+            rows = pending[key]
+            try:
+                rows.append(row_builder(element.attrib))
+            except KeyError as e:
+                #A missing date or value would be dropped by the transforms anyway
+                logging.warning(f"Skipped malformed record, missing attribute {e}")
+            else:
+                #Rows are counted per batch rather than per record
+                if len(rows) == BATCH_ROWS:
+                    write_batch(sinks[key][1], rows)
+                    counts[key] += len(rows)
+                    pending[key] = []
+                    logging.info(f"{key} - written {counts[key]} rows...")
+        #Frees the element and the already processed siblings so the tree does not grow in memory
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+    #Writes the remaining rows and the parquet footer of every sink
+    for key, (buffer, writer) in sinks.items():
+        if pending[key]:
+            write_batch(writer, pending[key])
+            counts[key] += len(pending[key])
+        writer.close()
+
+    #Uploads run in parallel since the S3 calls are network bound and release the GIL
+    with ThreadPoolExecutor(max_workers=len(sinks)) as executor:
+        futures = [
+            executor.submit(stream_write, 'iwatch-healthdata-csv', key, sinks[key][0], counts[key])
+            for key in sinks
+        ]
+        for future in futures:
+            future.result()
+
+    logging.info("All Parquet files written using lxml.")
 
 def run():
-    logging.info("Starting with ElementTree version...")
+    logging.info("Starting with lxml version...")
     start = time.time()
 
-    #Fetches the s3 object from the bucket
-    response = s3.get_object(
-        Bucket='iwatch-healthdata-raw',
-        Key='iwatch_health_export/export.xml'
+    #Fetches the s3 object from the bucket, reusing the local copy when the export has not changed
+    path = cached_download(
+        s3,
+        'iwatch-healthdata-raw',
+        'iwatch_health_export/export.xml',
+        config=transfer_config
     )
 
-    logging.info("Reading the whole memory file from the streaming object might take some time")
-    #Reads the whole memory file from the streaming object
-    xml_bytes = response['Body'].read()
-    #wraps the file into a seekable to allow multiple passes
-    parse_and_write(BytesIO(xml_bytes))
+    #Parses straight from the file on disk, a single pass does not need a copy in memory
+    with open(path, 'rb') as streaming_body:
+        parse_and_write(streaming_body)
 
     elapsed = round(time.time() - start, 2)
     logging.info(f"Job complete in {elapsed} seconds.")
@@ -1,11 +1,14 @@
 # Monthly Health Trends Dashboard (Apple Watch Data)
 import streamlit as st
 import pandas as pd
+import numpy as np
 import altair as alt
 import plotly.express as px
 import time
 import requests
 from io import BytesIO
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 
 
@@ -15,6 +18,24 @@ st.set_page_config(page_title="📊 Monthly Health Trends", layout="wide")
 #Sets the main title at the top of dashboard
 st.title("📊 Your Health Trends Over Time")
 
+# Seconds before a GitHub request gives up, so one hung download cannot block load_data
+REQUEST_TIMEOUT = 30
+# Last ETag seen for each file, used to find the persisted copy when GitHub cannot be reached
+ETAG_DIR = Path.home() / ".streamlit" / "etags"
+
+def download_parquet(url):
+    response = requests.get(url, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return pd.read_parquet(BytesIO(response.content))
+
+#Persisted to disk so restarts and redeploys reuse the previous download, the ETag argument
+#makes a changed file on GitHub a new cache entry and max_entries keeps one entry per file
+@st.cache_data(persist="disk", show_spinner=False, max_entries=4)
+def read_parquet_from_github(url, etag):
+    return download_parquet(url)
+
+weekday_order = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
 @st.cache_data
 def load_data():
 
@@ -27,21 +48,37 @@ def load_data():
         "steps": f"{base_url}/step.parquet",
     }
 
-    def read_parquet_from_github(url):
-        response = requests.get(url)
-        response.raise_for_status()
-        return pd.read_parquet(BytesIO(response.content))
-
-    heart = read_parquet_from_github(files["heart"])
-    sleep = read_parquet_from_github(files["sleep"])
-    resp = read_parquet_from_github(files["resp"])
-    steps = read_parquet_from_github(files["steps"])
-
+    def read_cached(url):
+        etag_file = ETAG_DIR / url.rsplit("/", 1)[-1]
+        try:
+            head = requests.head(url, timeout=REQUEST_TIMEOUT)
+            head.raise_for_status()
+            etag = head.headers.get("ETag")
+        except requests.RequestException:
+            # GitHub is down or rate limiting, fall back to the last persisted copy if there is one
+            if not etag_file.exists():
+                raise
+            etag = etag_file.read_text()
+
+        # Without an ETag a persisted copy could never be refreshed, so the file is downloaded directly
+        if etag is None:
+            return download_parquet(url)
+
+        df = read_parquet_from_github(url, etag)
+        ETAG_DIR.mkdir(parents=True, exist_ok=True)
+        etag_file.write_text(etag)
+        return df
+
+    # The four downloads are network bound, fetching them in parallel waits for the slowest one instead of the sum
+    with ThreadPoolExecutor(max_workers=len(files)) as executor:
+        heart, sleep, resp, steps = executor.map(read_cached, files.values())
+
+    # Calendar columns come precomputed from transform_data, older files without weekday get it here
     for df in [heart, sleep, resp, steps]:
-        df["created_at"] = pd.to_datetime(df["created_at"])
-        df["year"] = df["created_at"].dt.year
-        df["month"] = df["created_at"].dt.month
-        df["weekday"] = df["created_at"].dt.day_name()
+        if not pd.api.types.is_datetime64_any_dtype(df["created_at"]):
+            df["created_at"] = pd.to_datetime(df["created_at"])
+        if "weekday" not in df:
+            df["weekday"] = pd.Categorical(df["created_at"].dt.day_name(), categories=weekday_order, ordered=True)
 
     return heart, sleep, resp, steps
 
@@ -54,7 +91,6 @@ month_labels = {
     9: "September", 10: "October", 11: "November", 12: "December"
 }
 label_to_month = {v: k for k, v in month_labels.items()}
-weekday_order = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
 
 # Streamlit UI
 with st.sidebar:
@@ -87,9 +123,8 @@ with tabs[0]:
         use_container_width=True
     )
 
-    def zone(hr):
-        return "Resting" if hr < 60 else "Normal" if hr <= 90 else "High"
-    df["zone"] = df["avg_heart_rate"].apply(zone)
+    hr = df["avg_heart_rate"]
+    df["zone"] = np.select([hr < 60, hr <= 90], ["Resting", "Normal"], default="High")
     zone_counts = df["zone"].value_counts().reset_index()
     zone_counts.columns = ["HR Zone", "Days"]
     fig_zone = px.bar(zone_counts, x="HR Zone", y="Days", color="HR Zone",
@@ -117,7 +152,8 @@ with tabs[1]:
 
 
 
-    df["week"] = df["created_at"].dt.isocalendar().week
+    # Monday-based week of year (0/53 at year edges) from day of year and weekday, without building the isocalendar() frame
+    df["week"] = ((df["created_at"].dt.dayofyear - df["created_at"].dt.dayofweek + 9) // 7).astype("int8")
     week_avg = df.groupby("week")["total_sleep_minutes"].mean().reset_index()
     st.subheader("🥱 Sleep Duration per Week")
     st.bar_chart(week_avg.set_index("week"), height=250)
@@ -166,7 +202,6 @@ with tabs[3]:
     st.subheader("🚶 Was I active enough this month?")
     st.markdown("""You can see your daily step counts, how often you reached your step goal, and whether there were days with low movement (sedentary). Patterns by weekday can highlight habits. Days are now sorted correctly from Monday to Sunday.""")
     df = steps_df[(steps_df["year"] == year) & (steps_df["month"] == month)].copy()
-    df["weekday"] = pd.Categorical(df["created_at"].dt.day_name(), categories=weekday_order, ordered=True)
 
 
     st.altair_chart(
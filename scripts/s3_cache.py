@@ -0,0 +1,31 @@
+import logging
+import os
+from pathlib import Path
+
+#Local copies of S3 objects are kept here between runs, keyed by the object's ETag
+CACHE_DIR = Path('/tmp/iwatch-cache')
+
+#Returns a local path holding the S3 object, only downloading it when the ETag has changed since the last run
+def cached_download(s3, bucket, key, config=None):
+    head = s3.head_object(Bucket=bucket, Key=key)
+    etag = head['ETag'].strip('"')
+    suffix = key.replace('/', '_')
+    path = CACHE_DIR / f"{etag}-{suffix}"
+
+    if path.exists():
+        logging.info(f"Cache hit for {key}: {path}")
+        return path
+
+    logging.info(f"Cache miss for {key}, downloading to {path}")
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    #Downloads to a temporary name first so an interrupted run never leaves a partial file in the cache
+    partial = path.with_name(path.name + '.part')
+    s3.download_file(bucket, key, str(partial), Config=config)
+    os.replace(partial, path)
+
+    #Evicts the copies of older ETags and leftover partial downloads of the same key so the cache keeps one file per key
+    for stale in list(CACHE_DIR.glob(f"*-{suffix}")) + list(CACHE_DIR.glob(f"*-{suffix}.part")):
+        if stale != path:
+            logging.info(f"Evicting stale cache entry {stale}")
+            stale.unlink(missing_ok=True)
+    return path
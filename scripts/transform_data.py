@@ -1,167 +1,169 @@
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import boto3
+import duckdb
 import io
 import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
+from s3_cache import cached_download
 
 logging.basicConfig(level=logging.INFO,format='%(asctime)s - %(levelname)s - %(message)s')
 
 s3 = boto3.client('s3')
 source_bucket = 'iwatch-healthdata-csv'
 target_bucket = 'iwatch-healthdatatransform-parquet'
+#Large objects are fetched as parallel ranged GETs of 8 MB
+transfer_config = TransferConfig(max_concurrency=10, multipart_chunksize=8 * 1024 * 1024)
+calendar_dtypes = {'year': 'int16', 'month': 'int8', 'day': 'int8'}
 
+#The raw records are filtered and aggregated by DuckDB's vectorized engine straight from the parquet files
+#the timestamps are naive local wall-clock times, so date_trunc cuts days at the wearer's local midnight
+con = duckdb.connect()
 
-def read_csv_from_s3(key):
+
+#Fetches a typed parquet written by extract_data to the local cache, dates are local wall-clock timestamps and values float32
+def fetch_from_s3(key):
     logging.info(f"Read File: {key}")
     source_key = f'processed/{key}'
-    obj = s3.get_object(Bucket=source_bucket,Key = source_key)
-    df = pd.read_csv(io.BytesIO(obj['Body'].read()))
-    logging.info(f"Loaded{len(df):,} rows from {key}")
-    return df
+    path = cached_download(s3, source_bucket, source_key, config=transfer_config)
+    logging.info(f"Fetched {key} to {path}")
+    return path
 
 def write_parquet_tos3(df,key):
     logging.info(f"Writing {len(df):,} records to {key}")
     target_key = f'transformed_parquet/{key}/{key}.parquet'
     out_buffer = io.BytesIO() #Creating a buffer stream
-    df.to_parquet(out_buffer,index=False) #writing the df to the buffer stream
-    s3.put_object(Bucket= target_bucket, Key = target_key, Body=out_buffer.getvalue())
+    #Narrow date parts and zstd with dictionary encoding keep the files small for the dashboard downloads
+    table = pa.Table.from_pandas(df.astype(calendar_dtypes), preserve_index=False)
+    pq.write_table(table, out_buffer, compression='zstd', compression_level=9,
+                   use_dictionary=True, data_page_size=64 * 1024) #writing the table to the buffer stream
+    out_buffer.seek(0) #Uploading the buffer itself avoids copying it into a bytes object with getvalue()
+    s3.put_object(Bucket= target_bucket, Key = target_key, Body=out_buffer)
     logging.info(f"Upload completed for {target_key}")
 
+weekday_order = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+#Adds the calendar columns used for partitioning and by the dashboard filters and weekday charts
+#so the dashboard does not recompute them on every load
+def add_calendar_columns(daily):
+    daily['year'] = daily['created_at'].dt.year
+    daily['month'] = daily['created_at'].dt.month
+    daily['day'] = daily['created_at'].dt.day
+    #Ordered categorical so parquet stores it dictionary encoded and groupby works on the integer codes
+    daily['weekday'] = pd.Categorical(daily['created_at'].dt.day_name(), categories=weekday_order, ordered=True)
+    return daily
+
 """
 Heart Data Tasks:
-Convert created_at to datetime
+Drop rows without a created_at
 Filter out heart rates outside 30–220 bpm
 Aggregate daily average heart rate
-Add year, month, day columns for partitioning
+Add year, month, day columns for partitioning, plus weekday
 """
-def transform_heart_data(df):
+def transform_heart_data(path):
     logging.info("Transforming Heart Data")
-    df['created_at'] = pd.to_datetime(df['created_at'],errors ='coerce')
-    df['value'] = pd.to_numeric(df['value'], errors='coerce')
-    df = df[(df['value']>=30) & (df['value']<=220)]
-    df = df.dropna(subset=['created_at'])
-
-    heart_daily = (
-        df.groupby(df['created_at'].dt.date)
-        .agg(avg_heart_rate = ('value','mean'))
-        .reset_index()
-    )
-
-    heart_daily['created_at'] = pd.to_datetime(heart_daily['created_at'])
-    heart_daily['year'] = heart_daily['created_at'].dt.year
-    heart_daily['month'] = heart_daily['created_at'].dt.month
-    heart_daily['day'] = heart_daily['created_at'].dt.day
+    heart_daily = con.execute("""
+        SELECT date_trunc('day', created_at)::TIMESTAMP AS created_at,
+               avg(value) AS avg_heart_rate
+        FROM read_parquet($path)
+        WHERE created_at IS NOT NULL AND value BETWEEN 30 AND 220
+        GROUP BY 1
+        ORDER BY 1
+    """, {'path': str(path)}).df()
+
+    heart_daily = add_calendar_columns(heart_daily)
 
     return heart_daily
 
 """
 Respiration Data Tasks:
-Convert created_at to datetime
+Drop rows without a created_at
 Filter column count outside 8–40 bpm
 Aggregate daily average respiratory rate
-Add year, month, day columns
+Add year, month, day, weekday columns
 """
 
-def transform_resp_data(df):
+def transform_resp_data(path):
     logging.info("Transforming Respiratory Rate Data")
-    df['created_at'] = pd.to_datetime(df['created_at'],errors='coerce')
-    df['count'] = pd.to_numeric(df['count'], errors='coerce')
-    df=df[(df['count']>= 8) & (df['count']<=40)]
-    df = df.dropna(subset=['created_at'])
-
-    resp_daily = (
-        df.groupby(df['created_at'].dt.date)
-        .agg(avg_resp_rate=('count', 'mean'))
-        .reset_index()
-    )
-    resp_daily['created_at'] = pd.to_datetime(resp_daily['created_at'])
-    resp_daily['year'] = resp_daily['created_at'].dt.year
-    resp_daily['month'] = resp_daily['created_at'].dt.month
-    resp_daily['day'] = resp_daily['created_at'].dt.day
+    resp_daily = con.execute("""
+        SELECT date_trunc('day', created_at)::TIMESTAMP AS created_at,
+               avg("count") AS avg_resp_rate
+        FROM read_parquet($path)
+        WHERE created_at IS NOT NULL AND "count" BETWEEN 8 AND 40
+        GROUP BY 1
+        ORDER BY 1
+    """, {'path': str(path)}).df()
+    resp_daily = add_calendar_columns(resp_daily)
     return resp_daily
 
 """
 Sleep Data Tasks:
-Convert start_date and end_date to datetime
+Drop rows without created_at, start_date or end_date
 Drop sessions where end < start
 Compute sleep duration in minutes
-Aggregate daily sleep duration (per created_at)
-Add year, month, day
+Aggregate daily sleep duration (per local start day of the session, so evening sleep stays on its start date)
+Add year, month, day, weekday
 Fix the overlapping sleep sessions to get clean data.
 - Sometimes, sleep data contains overlapping or continuous sessions.
 - Merging prevents the overestimation of sleep duration.
+- Ordered by start, a segment opens a new session when it starts after every earlier segment has ended.
 """
-def transform_sleep_data(df):
+def transform_sleep_data(path):
     logging.info("Transforming Sleep Data")
-    
-    df['start_date'] = pd.to_datetime(df['start_date'], errors='coerce')
-    df['end_date'] = pd.to_datetime(df['end_date'], errors='coerce')
-    df['created_at'] = pd.to_datetime(df['created_at'], errors='coerce')
-    
-    df = df.dropna(subset=['created_at', 'start_date', 'end_date'])
-    df = df[df['end_date'] > df['start_date']]
-    
-    # Sort by start date for proper merging
-    df = df.sort_values(by=['created_at', 'start_date'])
-
-    # Merge overlapping sleep sessions
-    merged_sessions = []
-    current_start, current_end = None, None
-
-    # Simplified merging using zip
-    for start, end in zip(df['start_date'], df['end_date']):
-        if current_start is None:
-            current_start, current_end = start, end
-        elif start <= current_end:
-            # Extend the current session if overlapping
-            current_end = max(current_end, end)
-        else:
-            # Save the completed session and start a new one
-            merged_sessions.append((current_start, current_end))
-            current_start, current_end = start, end
-
-    # Add the last merged session
-    if current_start is not None:
-        merged_sessions.append((current_start, current_end))
-
-    # Convert merged sessions to a DataFrame
-    merged_df = pd.DataFrame(merged_sessions, columns=['start_date', 'end_date'])
-    merged_df['duration_mins'] = (merged_df['end_date'] - merged_df['start_date']).dt.total_seconds() / 60
-
-    # Aggregate daily sleep duration
-    merged_df['created_at'] = merged_df['start_date'].dt.date
-    sleep_daily = merged_df.groupby('created_at').agg(total_sleep_minutes=('duration_mins', 'sum')).reset_index()
-    sleep_daily['created_at'] = pd.to_datetime(sleep_daily['created_at'])
-    sleep_daily['year'] = sleep_daily['created_at'].dt.year
-    sleep_daily['month'] = sleep_daily['created_at'].dt.month
-    sleep_daily['day'] = sleep_daily['created_at'].dt.day
+    sleep_daily = con.execute("""
+        WITH segments AS (
+            SELECT start_date, end_date,
+                   max(end_date) OVER (ORDER BY start_date, end_date ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING) AS previous_end,
+                   row_number() OVER (ORDER BY start_date, end_date) AS rn
+            FROM read_parquet($path)
+            WHERE created_at IS NOT NULL AND start_date IS NOT NULL AND end_date IS NOT NULL
+              AND end_date > start_date
+        ),
+        -- Tied segments have no defined order, so the session count follows the row numbers of the pass above
+        numbered AS (
+            SELECT start_date, end_date,
+                   sum(CASE WHEN previous_end IS NULL OR start_date > previous_end THEN 1 ELSE 0 END)
+                       OVER (ORDER BY rn ROWS UNBOUNDED PRECEDING) AS session
+            FROM segments
+        ),
+        sessions AS (
+            SELECT min(start_date) AS start_date, max(end_date) AS end_date
+            FROM numbered
+            GROUP BY session
+        )
+        SELECT date_trunc('day', start_date)::TIMESTAMP AS created_at,
+               sum(epoch(end_date) - epoch(start_date)) / 60 AS total_sleep_minutes
+        FROM sessions
+        GROUP BY 1
+        ORDER BY 1
+    """, {'path': str(path)}).df()
+    sleep_daily = add_calendar_columns(sleep_daily)
 
     logging.info("Transformation complete")
     return sleep_daily
 
 """
 Step Data Tasks:
-Convert created_at to datetime
+Drop rows without a created_at
 Remove rows with step counts > 100,000
 Aggregate daily total steps
-Add year, month, day
+Add year, month, day, weekday
 """
 
-def transform_step_data(df):
+def transform_step_data(path):
     logging.info("Transforming Step Count data")
-    df['created_at'] = pd.to_datetime(df['created_at'], errors='coerce')
-    df = df[df['count'] <= 100000]
-    df = df.dropna(subset=['created_at'])
-
-    step_daily = (
-        df.groupby(df['created_at'].dt.date)
-        .agg(total_steps=('count', 'sum'))
-        .reset_index()
-    )
-    step_daily['created_at'] = pd.to_datetime(step_daily['created_at'])
-    step_daily['year'] = step_daily['created_at'].dt.year
-    step_daily['month'] = step_daily['created_at'].dt.month
-    step_daily['day'] = step_daily['created_at'].dt.day
+    step_daily = con.execute("""
+        SELECT date_trunc('day', created_at)::TIMESTAMP AS created_at,
+               sum("count")::BIGINT AS total_steps
+        FROM read_parquet($path)
+        WHERE created_at IS NOT NULL AND "count" <= 100000
+        GROUP BY 1
+        ORDER BY 1
+    """, {'path': str(path)}).df()
+    step_daily = add_calendar_columns(step_daily)
     return step_daily
 
 
@@ -175,21 +177,20 @@ def main():
     logging.info("Starting Health Transformation ETL Job")
 
     try:
-        heart_df = read_csv_from_s3('Heart_Data.csv')
-        heart_tf = transform_heart_data(heart_df)
-        write_parquet_tos3(heart_tf,'heart')
-
-        resp_df = read_csv_from_s3('Resp_Data.csv')
-        resp_tf = transform_resp_data(resp_df)
-        write_parquet_tos3(resp_tf,'resp')
-
-        sleep_df = read_csv_from_s3('Sleep_Data.csv')
-        sleep_tf = transform_sleep_data(sleep_df)
-        write_parquet_tos3(sleep_tf,'sleep')
-
-        step_df = read_csv_from_s3('Step_Data.csv')
-        step_tf = transform_step_data(step_df)
-        write_parquet_tos3(step_tf,'step')
+        #Source file, transform and target key of each dataset
+        jobs = [
+            ('Heart_Data.parquet', transform_heart_data, 'heart'),
+            ('Resp_Data.parquet', transform_resp_data, 'resp'),
+            ('Sleep_Data.parquet', transform_sleep_data, 'sleep'),
+            ('Step_Data.parquet', transform_step_data, 'step'),
+        ]
+
+        #All downloads start up-front so they overlap with the transform of the dataset already fetched
+        with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+            downloads = [executor.submit(fetch_from_s3, source) for source, _, _ in jobs]
+            for (source, transform, target), download in zip(jobs, downloads):
+                transformed = transform(download.result())
+                write_parquet_tos3(transformed, target)
 
         logging.info("Health Transformation ETL Job completed")
 